@@ -1,10 +1,16 @@
 import paho.mqtt.client as mqtt
-import json
 import csv
 import datetime
 import os
+import re
 import time
 
+# Prefer orjson for payload parsing (parses bytes directly); fall back to the stdlib.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
 # --- Configuration ---
 # Replace 'localhost' with the IP or hostname of your MQTT broker if it's different.
 MQTT_BROKER = 'localhost'
@@ -16,17 +22,57 @@ CSV_FILE_PATH = "power_log_gus.csv"
 POWER_KEY = "apower"
 # Time in seconds between attempts to reconnect to the MQTT broker.
 RECONNECT_DELAY_S = 5
+# Flush buffered CSV rows to disk after this many rows or seconds, whichever comes first.
+CSV_FLUSH_ROWS = 50
+CSV_FLUSH_INTERVAL_S = 60
+# Fast path: pull the power value straight out of the raw payload without parsing
+# the whole Shelly status document. Falls back to a full JSON parse on no match.
+POWER_RE = re.compile(rb'"' + re.escape(POWER_KEY.encode()) + rb'"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)')
+# Only echo every Nth logged sample to the console (printing is blocking I/O on the Pi).
+PRINT_EVERY_N_ROWS = 10
+
+# Cache of the formatted date/time part of the current second (see iso_timestamp).
+_last_ts_sec = None
+_last_ts_str = ''
 
 def initialize_csv(filepath):
-    """Creates the CSV file with headers if it doesn't already exist."""
+    """Opens the CSV file for appending, writing headers if it doesn't already exist.
+
+    Returns the open file handle and a csv.writer bound to it; both are kept for
+    the lifetime of the logger instead of re-opening the file on every message.
+    """
     file_exists = os.path.exists(filepath)
-    with open(filepath, 'a', newline='') as csvfile:
-        fieldnames = ['timestamp', 'power_w']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-        
-        if not file_exists or os.stat(filepath).st_size == 0:
-            writer.writeheader()
-            print(f"[{datetime.datetime.now().isoformat()}] Created new CSV file: {filepath}")
+    csvfile = open(filepath, 'a', newline='', buffering=1 << 16)
+    writer = csv.writer(csvfile)
+
+    if not file_exists or os.stat(filepath).st_size == 0:
+        writer.writerow(('timestamp', 'power_w'))
+        csvfile.flush()
+        print(f"[{datetime.datetime.now().isoformat()}] Created new CSV file: {filepath}")
+
+    return csvfile, writer
+
+def iso_timestamp():
+    """Returns the current local time in datetime.isoformat() format.
+
+    The date/time part is only re-formatted when the second changes; the
+    microseconds are appended to the cached string.
+    """
+    global _last_ts_sec, _last_ts_str
+    now = time.time()
+    sec = int(now)
+    if sec != _last_ts_sec:
+        _last_ts_str = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(sec))
+        _last_ts_sec = sec
+    usec = int((now - sec) * 1_000_000)
+    return f"{_last_ts_str}.{usec:06d}" if usec else _last_ts_str
+
+def flush_csv(log):
+    """Flushes buffered rows to disk and resets the flush counters."""
+    log['file'].flush()
+    os.fsync(log['file'].fileno())
+    log['pending_rows'] = 0
+    log['last_flush'] = time.monotonic()
 
 def on_connect(client, userdata, flags, rc):
     """The callback for when the client receives a CONNACK response from the server."""
@@ -42,39 +88,43 @@ def on_connect(client, userdata, flags, rc):
 def on_message(client, userdata, msg):
     """The callback for when a PUBLISH message is received from the server."""
     try:
-        # 1. Parse the payload from bytes to a JSON object
-        payload = msg.payload.decode('utf-8')
-        data = json.loads(payload)
-        
-        # 2. Extract the power value
-        power_value = data.get(POWER_KEY)
+        # 1./2. Extract the power value, parsing the full JSON payload only if needed
+        match = POWER_RE.search(msg.payload)
+        if match:
+            power_value = float(match.group(1))
+        else:
+            data = _json.loads(msg.payload)
+            power_value = data.get(POWER_KEY)
 
         if power_value is not None:
             # 3. Get the current timestamp
-            current_time = datetime.datetime.now().isoformat()
-            
-            # 4. Log the data
-            log_data = {'timestamp': current_time, 'power_w': power_value}
+            current_time = iso_timestamp()
             
-            with open(CSV_FILE_PATH, 'a', newline='') as csvfile:
-                fieldnames = ['timestamp', 'power_w']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writerow(log_data)
+            # 4. Log the data (buffered; flushed every CSV_FLUSH_ROWS rows or CSV_FLUSH_INTERVAL_S seconds)
+            userdata['writer'].writerow((current_time, power_value))
+            userdata['pending_rows'] += 1
+            if (userdata['pending_rows'] >= CSV_FLUSH_ROWS
+                    or time.monotonic() - userdata['last_flush'] >= CSV_FLUSH_INTERVAL_S):
+                flush_csv(userdata)
             
-            print(f"[{current_time}] LOGGED: Power={power_value} W")
+            userdata['rows_logged'] += 1
+            if userdata['rows_logged'] % PRINT_EVERY_N_ROWS == 0:
+                print(f"[{current_time}] LOGGED: Power={power_value} W")
         else:
-            print(f"[{datetime.datetime.now().isoformat()}] WARNING: '{POWER_KEY}' key not found in payload: {payload[:50]}...")
+            print(f"[{datetime.datetime.now().isoformat()}] WARNING: '{POWER_KEY}' key not found in payload: {msg.payload[:50]}...")
 
-    except json.JSONDecodeError:
-        print(f"[{datetime.datetime.now().isoformat()}] ERROR: Could not decode JSON payload: {msg.payload.decode('utf-8')}")
+    except _json.JSONDecodeError:
+        print(f"[{datetime.datetime.now().isoformat()}] ERROR: Could not decode JSON payload: {msg.payload.decode('utf-8', errors='replace')}")
     except Exception as e:
         print(f"[{datetime.datetime.now().isoformat()}] UNEXPECTED ERROR: {e}")
 
 def main():
-    # Ensure the CSV file is ready
-    initialize_csv(CSV_FILE_PATH)
+    # Ensure the CSV file is ready and keep it open for the whole session
+    csvfile, writer = initialize_csv(CSV_FILE_PATH)
+    log = {'file': csvfile, 'writer': writer, 'pending_rows': 0, 'rows_logged': 0,
+           'last_flush': time.monotonic()}
     
-    client = mqtt.Client(client_id="ShellyPowerLogger")
+    client = mqtt.Client(client_id="ShellyPowerLogger", userdata=log)
     client.on_connect = on_connect
     client.on_message = on_message
 
@@ -99,5 +149,8 @@ def main():
         # Wait before retrying connection
         time.sleep(RECONNECT_DELAY_S)
 
+    flush_csv(log)
+    csvfile.close()
+
 if __name__ == "__main__":
     main()
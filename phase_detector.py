@@ -6,62 +6,153 @@ Uses trained Random Forest model to predict washing machine phases
 
 import joblib
 import numpy as np
-from collections import deque
 from scipy.signal import savgol_filter
 
 class MLPhaseDetector:
+    __slots__ = (
+        "model", "history_size", "_buf", "_head", "_n", "window_size",
+        "_forest", "_savgol_matrix",
+    )
+
     def __init__(self, model_path='/home/andrea/iot-broker/random_forest_phase_classifier.pkl'):
         """Initialize ML phase detector"""
         print(f"Loading ML model from {model_path}...")
         self.model = joblib.load(model_path)
         print(f"✅ Model loaded successfully")
         
-        # Buffers for feature extraction
-        self.power_buffer = deque(maxlen=120)  # Store 2 hours of history
+        # Ring buffer for feature extraction. Each reading is written twice (at head and
+        # head + history_size) so the most recent window is always a contiguous slice.
+        # Readings are stored as int16 tenths of a watt (Shelly reports 0.1 W resolution).
+        self.history_size = 120  # Store 2 hours of history
+        self._buf = np.zeros(2 * self.history_size, dtype=np.int16)
+        self._head = 0  # Next write position in [0, history_size)
+        self._n = 0     # Number of readings stored, capped at history_size
         self.window_size = 18  # Must match training window size (trained with 18)
+
+        # Flattened copy of the forest for vectorized inference (None if unsupported)
+        try:
+            self._forest = self._compile_forest()
+        except Exception as e:
+            print(f"⚠️ Could not compile forest, using per-tree prediction: {e}")
+            self._forest = None
+
+        # Savitzky-Golay smoothing (window 11, order 3) over a fixed-length window is a
+        # linear map, so precompute it once as a matrix and apply it with a single matmul.
+        if self.window_size >= 11:
+            self._savgol_matrix = savgol_filter(np.eye(self.window_size), window_length=11, polyorder=3, axis=0)
+        else:
+            self._savgol_matrix = None
         
     def add_power_reading(self, power):
         """Add new power reading"""
-        self.power_buffer.append(power)
+        quantized = min(max(round(power * 10), -32768), 32767)
+        head = self._head
+        self._buf[head] = quantized
+        self._buf[head + self.history_size] = quantized
+        self._head = head + 1 if head + 1 < self.history_size else 0
+        if self._n < self.history_size:
+            self._n += 1
     
     def extract_features(self):
         """Extract features from power buffer (same as training)"""
-        if len(self.power_buffer) < self.window_size:
+        if self._n < self.window_size:
             return None
         
-        # Get recent power readings
-        recent_power = list(self.power_buffer)[-self.window_size:]
+        # Get recent power readings, converted back to watts
+        end = self._head + self.history_size
+        recent_power = self._buf[end - self.window_size:end] / 10.0
         
         # Apply Savitzky-Golay smoothing
-        if len(recent_power) >= 11:
-            power_smooth = savgol_filter(recent_power, window_length=11, polyorder=3)
+        if self._savgol_matrix is not None:
+            power_smooth = self._savgol_matrix @ recent_power
         else:
-            power_smooth = np.array(recent_power)
+            power_smooth = recent_power
         
-        # Extract features for each sample in window
-        features = []
-        for i in range(len(recent_power)):
-            # Rolling statistics
-            window_data = power_smooth[max(0, i-3):i+1]
-            
-            # Basic features (11 features) - matches trained model
-            feat = [
-                power_smooth[i],                          # power_smooth
-                np.mean(window_data[-2:]) if len(window_data) >= 2 else power_smooth[i],  # power_avg_30s
-                np.mean(window_data),                     # power_avg_60s
-                np.std(window_data[-2:]) if len(window_data) >= 2 else 0,  # power_std_30s
-                np.std(window_data),                      # power_std_60s
-                np.min(window_data[-2:]) if len(window_data) >= 2 else power_smooth[i],  # power_min_30s
-                np.max(window_data[-2:]) if len(window_data) >= 2 else power_smooth[i],  # power_max_30s
-                (np.max(window_data[-2:]) - np.min(window_data[-2:])) if len(window_data) >= 2 else 0,  # power_range_30s
-                np.gradient(power_smooth)[i] if i > 0 else 0,  # power_derivative
-                len(window_data),                         # time_in_range
-                (np.max(window_data) - np.min(window_data)) / (np.mean(window_data) + 1e-6) if len(window_data) > 1 else 0  # power_oscillation
-            ]
-            
-            features.extend(feat)
-        
-        return np.array(features).reshape(1, -1)
+        # Extract features for every sample in the window in one vectorized pass.
+        # Rolling windows are the last 2 (30s) and last 4 (60s) samples, truncated
+        # at the start of the window exactly as the per-sample loop used to do.
+        n = len(power_smooth)
+        padded = np.concatenate((np.full(3, np.nan), power_smooth))
+        window_60s = np.lib.stride_tricks.sliding_window_view(padded, 4)
+        prev = np.concatenate((power_smooth[:1], power_smooth[:-1]))
+        has_prev = np.arange(n) > 0
+
+        mean_60s = np.nanmean(window_60s, axis=1)
+        min_60s = np.nanmin(window_60s, axis=1)
+        max_60s = np.nanmax(window_60s, axis=1)
+        min_30s = np.minimum(prev, power_smooth)
+        max_30s = np.maximum(prev, power_smooth)
+
+        # Fresh per call: predict_phase can run concurrently from the publish timer and
+        # the MQTT thread. 11 features per sample, flattened row-major for the model;
+        # float32 is the dtype sklearn trees split on, so no conversion is needed at predict time.
+        features = np.empty((n, 11), dtype=np.float32)
+        features[:, 0] = power_smooth                                        # power_smooth
+        features[:, 1] = (prev + power_smooth) / 2                           # power_avg_30s
+        features[:, 2] = mean_60s                                            # power_avg_60s
+        features[:, 3] = np.abs(power_smooth - prev) / 2                     # power_std_30s
+        features[:, 4] = np.nanstd(window_60s, axis=1)                       # power_std_60s
+        features[:, 5] = min_30s                                             # power_min_30s
+        features[:, 6] = max_30s                                             # power_max_30s
+        features[:, 7] = max_30s - min_30s                                   # power_range_30s
+        features[0, 8] = 0                                                   # power_derivative
+        features[1:-1, 8] = (power_smooth[2:] - power_smooth[:-2]) * 0.5     # (central difference,
+        features[-1, 8] = power_smooth[-1] - power_smooth[-2]                #  as np.gradient)
+        features[:, 9] = np.minimum(np.arange(1, n + 1), 4)                  # time_in_range
+        features[:, 10] = np.where(has_prev, (max_60s - min_60s) / (mean_60s + 1e-6), 0)  # power_oscillation
+
+        return features.reshape(1, -1)
+    
+    def _compile_forest(self):
+        """Flatten all trees of the forest into shared node arrays.
+
+        Node ids are offset per tree so one set of arrays holds the whole forest.
+        Leaves point to themselves, so walking every tree max_depth steps always
+        ends on its leaf. Leaf values are pre-normalized class probabilities.
+        """
+        trees = [estimator.tree_ for estimator in self.model.estimators_]
+        offsets = np.cumsum([0] + [tree.node_count for tree in trees[:-1]])
+
+        feature = np.concatenate([tree.feature for tree in trees]).astype(np.intp)
+        threshold = np.concatenate([tree.threshold for tree in trees])
+        left = np.concatenate([tree.children_left for tree in trees]).astype(np.intp)
+        right = np.concatenate([tree.children_right for tree in trees]).astype(np.intp)
+        is_leaf = left == -1
+        node_ids = np.arange(len(feature))
+        node_offsets = np.repeat(offsets, [tree.node_count for tree in trees])
+        left = np.where(is_leaf, node_ids, left + node_offsets)
+        right = np.where(is_leaf, node_ids, right + node_offsets)
+        feature[is_leaf] = 0
+
+        values = np.concatenate([tree.value[:, 0, :] for tree in trees])
+        normalizer = values.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.0] = 1.0
+        leaf_proba = values / normalizer
+
+        max_depth = max(tree.max_depth for tree in trees)
+        return offsets.astype(np.intp), feature, threshold, left, right, leaf_proba, max_depth
+
+    def _predict_proba(self, features):
+        """Average class probabilities over the forest's trees.
+
+        Equivalent to model.predict_proba for a single sample. With a compiled
+        forest all trees are walked together one level at a time; otherwise each
+        tree is called with check_input=False, since features are already a
+        C-contiguous float32 row and sklearn's per-call validation is overhead.
+        """
+        if self._forest is not None:
+            roots, feature, threshold, left, right, leaf_proba, max_depth = self._forest
+            x = features[0]
+            nodes = roots
+            for _ in range(max_depth):
+                nodes = np.where(x[feature[nodes]] <= threshold[nodes], left[nodes], right[nodes])
+            return leaf_proba[nodes].mean(axis=0)
+
+        proba = np.zeros(len(self.model.classes_))
+        for tree in self.model.estimators_:
+            proba += tree.predict_proba(features, check_input=False)[0]
+        proba /= len(self.model.estimators_)
+        return proba
     
     def predict_phase(self):
         """Predict current washing machine phase"""
@@ -71,12 +162,12 @@ class MLPhaseDetector:
             return "IDLE", 0.0  # Not enough data yet
         
         try:
-            # Predict phase
-            phase = self.model.predict(features)[0]
-            
-            # Get confidence
-            probabilities = self.model.predict_proba(features)[0]
-            confidence = np.max(probabilities)
+            # Predict phase from a single probability pass (model.predict would
+            # evaluate the whole forest again just to take the argmax)
+            probabilities = self._predict_proba(features)
+            best = np.argmax(probabilities)
+            phase = str(self.model.classes_[best])
+            confidence = float(probabilities[best])
             
             return phase, confidence
             
@@ -1,11 +1,24 @@
 #!/usr/bin/env python3
 import paho.mqtt.client as mqtt
 import json
+import os
+import re
 import time
+import threading
 from datetime import datetime
 from enum import Enum
 from collections import defaultdict
 
+# Prefer orjson for payload parsing and serialization (works on bytes directly);
+# fall back to the stdlib.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+# Fast path for the only field needed from Shelly status payloads
+APOWER_RE = re.compile(rb'"apower"\s*:\s*(-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)')
+
 # Configuration
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
@@ -31,6 +44,12 @@ class MachineState(Enum):
 
 class MachineMonitor:
     """Monitors a single machine's state and aggregates power readings for averaging."""
+
+    __slots__ = (
+        "machine_id", "name", "current_threshold", "state", "current_power",
+        "power_readings_sum", "power_readings_count", "door_is_open",
+        "door_open_start_time", "cycle_count", "last_state_change",
+    )
     
     def __init__(self, machine_id, config):
         self.machine_id = machine_id
@@ -50,13 +69,14 @@ class MachineMonitor:
         self.last_state_change = datetime.now()
         
     def update_power(self, power):
-        if power is not None:
-            self.power_readings_sum += power
-            self.power_readings_count += 1
+        """Add a reading to the running sum; callers filter out missing (None) readings."""
+        self.power_readings_sum += power
+        self.power_readings_count += 1
         
     def calculate_and_reset_average(self):
         if self.power_readings_count > 0:
-            avg_power = self.power_readings_sum / self.power_readings_count
+            # Rounded once here so status and payloads can use it as-is
+            avg_power = round(self.power_readings_sum / self.power_readings_count, 2)
             self.current_power = avg_power
             self.power_readings_sum = 0
             self.power_readings_count = 0
@@ -108,7 +128,7 @@ class MachineMonitor:
             "machine_id": self.machine_id,
             "name": self.name,
             "state": self.state.value,
-            "power": round(self.current_power, 2),
+            "power": self.current_power,
             "door_open": self.door_is_open,
             "cycle_count": self.cycle_count,
             "last_change": self.last_state_change.isoformat()
@@ -123,6 +143,12 @@ class MultiMachineMonitor:
             for machine_id, config in machines_config.items()
         }
         self.load_cycle_counts()
+
+        # Cycle counts are written by a background thread so the MQTT callback never blocks on disk
+        self._write_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._writer = threading.Thread(target=self._cycle_count_writer, daemon=True)
+        self._writer.start()
         
     def load_cycle_counts(self):
         """Load saved cycle counts from file"""
@@ -139,14 +165,30 @@ class MultiMachineMonitor:
             print(f"Error loading cycle counts: {e}")
     
     def save_cycle_counts(self):
-        """Save cycle counts to file"""
+        """Request that cycle counts be saved by the background writer"""
+        self._dirty.set()
+
+    def _cycle_count_writer(self):
+        """Background loop: write cycle counts whenever they are marked dirty"""
+        while True:
+            self._dirty.wait()
+            self._dirty.clear()
+            self.write_cycle_counts()
+
+    def write_cycle_counts(self):
+        """Write cycle counts to file atomically (temp file + rename)"""
         try:
             counts = {
                 machine_id: monitor.cycle_count
                 for machine_id, monitor in self.monitors.items()
             }
-            with open(CYCLE_COUNT_FILE, 'w') as f:
-                json.dump(counts, f, indent=2)
+            tmp_path = CYCLE_COUNT_FILE + ".tmp"
+            with self._write_lock:
+                with open(tmp_path, 'w') as f:
+                    json.dump(counts, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, CYCLE_COUNT_FILE)
         except Exception as e:
             print(f"Error saving cycle counts: {e}")
     
@@ -164,6 +206,9 @@ class MultiMachineMonitor:
 # Global monitor manager
 monitor_manager = None
 
+# Timer driving the periodic publish
+publish_timer = None
+
 def publish_machine_data(client):
     """
     Publish all machine data periodically. 
@@ -178,32 +223,49 @@ def publish_machine_data(client):
             timestamp,
             machine_id,
             monitor.cycle_count,
-            round(average_power, 2),  # Use the calculated average here
+            average_power,  # Use the calculated average here
             monitor.state.value
         ]
         
         # Publish as JSON array
         topic = f"{machine_id}/data"
-        payload = json.dumps(data_row)
+        payload = _json.dumps(data_row)
         client.publish(topic, payload, retain=False)
         
         print(f"[{datetime.now().strftime('%H:%M:%S')}] Published (Avg): {data_row}")
 
+def schedule_publish(client):
+    """Arm a one-shot timer for the next periodic publish"""
+    global publish_timer
+    publish_timer = threading.Timer(PUBLISH_INTERVAL, publish_tick, args=(client,))
+    publish_timer.daemon = True
+    publish_timer.start()
+
+def publish_tick(client):
+    """Timer callback: re-arm the timer first so the cadence survives publish errors"""
+    schedule_publish(client)
+    try:
+        publish_machine_data(client)
+    except Exception as e:
+        print(f"Error publishing machine data: {e}")
+
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to the broker"""
     if rc == 0:
         print("Connected to MQTT Broker!")
         print("\nSubscribing to topics:")
         
-        # Subscribe to all hall sensors
+        # Subscribe to all hall sensors, each with its own per-machine handler
         for machine_id in MACHINES.keys():
             hall_topic = f"{machine_id}/hall_sensor/state"
+            client.message_callback_add(hall_topic, make_hall_callback(monitor_manager.get_monitor(machine_id)))
             client.subscribe(hall_topic)
             print(f"  - {hall_topic}")
         
         # Subscribe to all Shelly plugs
         for machine_id, config in MACHINES.items():
             shelly_topic = config["shelly_topic"]
+            client.message_callback_add(shelly_topic, make_power_callback(monitor_manager.get_monitor(machine_id)))
             client.subscribe(shelly_topic)
             print(f"  - {shelly_topic}")
         
@@ -212,45 +274,48 @@ def on_connect(client, userdata, flags, rc):
     else:
         print(f"Failed to connect, return code {rc}")
 
-def on_message(client, userdata, msg):
-    """Callback for when a message is received"""
-    try:
-        # Check if it's a hall sensor message
-        if "/hall_sensor/state" in msg.topic:
-            machine_id = msg.topic.split("/")[0]
-            monitor = monitor_manager.get_monitor(machine_id)
+def make_hall_callback(monitor):
+    """Build the message callback for one machine's hall sensor topic"""
+    def on_hall_message(client, userdata, msg):
+        try:
+            door_state = int(msg.payload.decode())
+            monitor.update_door(door_state == 1)
             
-            if monitor:
-                door_state = int(msg.payload.decode())
-                monitor.update_door(door_state == 1)
-                
-                state_changed, cycle_completed = monitor.check_transitions()
-                
-                if state_changed:
-                    print(f"[{datetime.now().strftime('%H:%M:%S')}] {monitor.name}: {monitor.state.value}")
-                    
-                if cycle_completed:
-                    monitor_manager.save_cycle_counts()
-                    print(f"Cycle completed; Total cycles: {monitor.cycle_count}")
-        
-        # If not hall sensor then is plug
-        else:
-            # Find which machine this Shelly belongs to
-            for machine_id, config in MACHINES.items():
-                if msg.topic == config["shelly_topic"]:
-                    monitor = monitor_manager.get_monitor(machine_id)
-                    if monitor:
-                        data = json.loads(msg.payload.decode())
-                        power = data.get("apower", 0.0)
-                        monitor.update_power(power)
-                        state_changed, _ = monitor.check_transitions()
-                        if state_changed:
-                            print(f"[{datetime.now().strftime('%H:%M:%S')}] {monitor.name}: {monitor.state.value}")
-                    break
+            state_changed, cycle_completed = monitor.check_transitions()
             
-    except Exception as e:
-        print(f"Error processing message: {e}")
-        print(f"Topic: {msg.topic}, Payload: {msg.payload}")
+            if state_changed:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {monitor.name}: {monitor.state.value}")
+                
+            if cycle_completed:
+                monitor_manager.save_cycle_counts()
+                print(f"Cycle completed; Total cycles: {monitor.cycle_count}")
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            print(f"Topic: {msg.topic}, Payload: {msg.payload}")
+    return on_hall_message
+
+def make_power_callback(monitor):
+    """Build the message callback for one machine's Shelly plug topic"""
+    def on_power_message(client, userdata, msg):
+        try:
+            match = APOWER_RE.search(msg.payload)
+            if match:
+                power = float(match.group(1))
+            else:
+                power = _json.loads(msg.payload).get("apower", 0.0)
+            if power is not None:
+                monitor.update_power(power)
+            state_changed, _ = monitor.check_transitions()
+            if state_changed:
+                print(f"[{datetime.now().strftime('%H:%M:%S')}] {monitor.name}: {monitor.state.value}")
+        except Exception as e:
+            print(f"Error processing message: {e}")
+            print(f"Topic: {msg.topic}, Payload: {msg.payload}")
+    return on_power_message
+
+def on_message(client, userdata, msg):
+    """Fallback callback for messages on topics without a registered handler"""
+    print(f"Ignoring message on unexpected topic: {msg.topic}")
 
 def main():
     """Main function to start the MQTT client"""
@@ -277,25 +342,18 @@ def main():
         print(f"Failed to connect to MQTT broker: {e}")
         return
     
-    # Start non-blocking loop
-    client.loop_start()
-    
-    # Start the loop with periodic checks and publishing
+    # Publish periodically from a timer thread; the main thread runs the network loop
     print("\nMonitoring... (Press Ctrl+C to exit)\n")
-    last_publish_time = time.time()
+    schedule_publish(client)
     
     try:
-        while True:
-            # Check if it's time to publish data
-            current_time = time.time()
-            if current_time - last_publish_time >= PUBLISH_INTERVAL:
-                publish_machine_data(client)
-                last_publish_time = current_time
-            time.sleep(1)  # Check every second
+        # Blocking call that processes network traffic, dispatches callbacks and
+        # handles reconnecting, so no separate loop_start() thread is needed.
+        client.loop_forever()
     except KeyboardInterrupt:
         print("\nShutting down...")
-        monitor_manager.save_cycle_counts()
-        client.loop_stop()
+        publish_timer.cancel()
+        monitor_manager.write_cycle_counts()
         client.disconnect()
 
 if __name__ == "__main__":
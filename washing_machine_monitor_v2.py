@@ -1,12 +1,22 @@
 #!/usr/bin/env python3
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 import ssl
 import json
+import os
 import time
 import logging
+import threading
+import zlib
 from datetime import datetime
 from enum import Enum
-from threading import Lock
+
+# Prefer orjson for payload (de)serialization (works on bytes directly); fall back to the stdlib.
+try:
+    import orjson as _json
+except ImportError:
+    import json as _json
 
 # ---- Logging Setup ----
 logging.basicConfig(level=logging.INFO)
@@ -15,6 +25,15 @@ logger = logging.getLogger(__name__)
 # ---- AWS IoT Core Configuration ----
 AWS_IOT_BROKER = "a5916n61elm51-ats.iot.ap-southeast-1.amazonaws.com"
 AWS_IOT_PORT = 8883
+# MQTT v5 persistent session: the broker keeps in-flight QoS 1 messages this long across disconnects
+AWS_SESSION_EXPIRY = 3600  # seconds
+# Bound paho's outbound buffers so a long AWS outage can't grow memory without limit;
+# once the queue is full new publishes are dropped (and logged) until it drains
+AWS_MAX_INFLIGHT = 20
+AWS_MAX_QUEUED = 1000
+# Let mosquitto's bridge forward washer/# to AWS IoT Core (see mosquitto-bridge.conf):
+# the monitor then only talks to the local broker, over one client and no TLS
+USE_MOSQUITTO_BRIDGE = False
 
 CA_PATH = "/home/andrea/aws-iot/certs/AmazonRootCA1.pem"
 CERT_PATH = "/home/andrea/aws-iot/certs/device.pem.crt"
@@ -34,16 +53,19 @@ MACHINES = {
     "WM-02": {
         "name": "Washing Machine 2",
         "shelly_topic": "simulator/WM-02/shelly",
+        "combined_topic": "simulator/WM-02/all",
         "current_threshold": 8.0
     },
     "WM-03": {
         "name": "Washing Machine 3",
         "shelly_topic": "simulator/WM-03/shelly",
+        "combined_topic": "simulator/WM-03/all",
         "current_threshold": 8.0
     },
     "WM-04": {
         "name": "Washing Machine 4",
         "shelly_topic": "simulator/WM-04/shelly",
+        "combined_topic": "simulator/WM-04/all",
         "current_threshold": 8.0
     }
 }
@@ -52,6 +74,12 @@ MACHINES = {
 DOOR_OPEN_DURATION = 10  # seconds
 CYCLE_COUNT_FILE = "machine_cycles.json"
 PUBLISH_INTERVAL = 30
+# Publish one message per machine to washer/{id}/data. Set to False to send all machines
+# in a single message to BATCH_TOPIC once the backend IoT rule consumes that topic.
+PUBLISH_PER_MACHINE = True
+BATCH_TOPIC = "washer/batch/data"
+# The simulator can zlib-compress its JSON messages; it then appends this suffix to the topic
+COMPRESSED_SUFFIX = "/z"
 
 class MachineState(Enum):
     IDLE = "IDLE"
@@ -61,66 +89,82 @@ class MachineState(Enum):
 class MachineMonitor:
     """Monitors a single machine's state and aggregates power readings for averaging."""
 
+    __slots__ = (
+        "machine_id", "name", "current_threshold", "th_high", "th_low",
+        "state", "current_power", "power_totals", "power_totals_reported",
+        "door_is_open", "door_open_start_time", "cycle_count", "last_state_change",
+    )
+
     def __init__(self, machine_id, config):
         self.machine_id = machine_id
         self.name = config["name"]
         self.current_threshold = config["current_threshold"]
+        # 20% hysteresis band around the threshold, fixed per machine
+        self.th_high = self.current_threshold * 1.2
+        self.th_low = self.current_threshold * 0.8
 
         self.state = MachineState.IDLE
         self.current_power = 0.0
 
-        # Power averaging fields
-        self.power_readings_sum = 0.0
-        self.power_readings_count = 0
+        # Power averaging fields: running (sum, count) of all readings, and the totals
+        # already averaged. Only the MQTT network thread writes power_totals, always as
+        # one tuple assignment, so the publish thread can read a consistent pair without
+        # taking a lock.
+        self.power_totals = (0.0, 0)
+        self.power_totals_reported = (0.0, 0)
 
         self.door_is_open = True  # Door starts open in IDLE state
         self.door_open_start_time = None
         self.cycle_count = 0
         self.last_state_change = datetime.now()
 
-        self.power_lock = Lock()
     def update_power(self, power):
-        with self.power_lock:
-            if power is not None:
-                self.power_readings_sum += power
-                self.power_readings_count += 1
+        if power is not None:
+            total, count = self.power_totals
+            self.power_totals = (total + power, count + 1)
 
     def calculate_and_reset_average(self):
-        with self.power_lock:
-            if self.power_readings_count > 0:
-                avg_power = self.power_readings_sum / self.power_readings_count
-                self.current_power = avg_power
-                self.power_readings_sum = 0
-                self.power_readings_count = 0
-                return avg_power
-
-            # No new readings were recorded, DO NOT update self.power
-            return self.current_power
+        # Average only the readings added since the last call
+        total, count = self.power_totals
+        reported_total, reported_count = self.power_totals_reported
+        if count > reported_count:
+            # Rounded once here so status and payloads can use it as-is
+            avg_power = round((total - reported_total) / (count - reported_count), 2)
+            self.current_power = avg_power
+            self.power_totals_reported = (total, count)
+            return avg_power
+
+        # No new readings were recorded, DO NOT update self.power
+        return self.current_power
 
     def update_door(self, is_open):
         self.door_is_open = is_open
         if not is_open:
             self.door_open_start_time = None
 
-    def check_transitions(self):
+    def check_transitions(self, now=None):
+        """Evaluate state transitions; `now` is an optional time.time() value cached by the caller."""
         new_state = None
         cycle_completed = False
+        state = self.state  # Enum members are singletons: compare by identity
 
-        if self.state == MachineState.IDLE:
-            if self.current_power > self.current_threshold * 1.2:  # 20% hysteresis
+        if state is MachineState.IDLE:
+            if self.current_power > self.th_high:
                 new_state = MachineState.RUNNING
                 self.door_is_open = False
                 self.door_open_start_time = None
 
-        elif self.state == MachineState.RUNNING:
-            if self.current_power <= self.current_threshold * 0.8:  # 20% hysteresis
+        elif state is MachineState.RUNNING:
+            if self.current_power <= self.th_low:
                 new_state = MachineState.OCCUPIED
 
-        elif self.state == MachineState.OCCUPIED:
+        elif state is MachineState.OCCUPIED:
             if self.door_is_open:
+                if now is None:
+                    now = time.time()
                 if self.door_open_start_time is None:
-                    self.door_open_start_time = time.time()
-                elif time.time() - self.door_open_start_time >= DOOR_OPEN_DURATION:
+                    self.door_open_start_time = now
+                elif now - self.door_open_start_time >= DOOR_OPEN_DURATION:
                     new_state = MachineState.IDLE
                     self.door_is_open = True
                     self.door_open_start_time = None
@@ -129,7 +173,7 @@ class MachineMonitor:
             else:
                 self.door_open_start_time = None
 
-        if new_state and new_state != self.state:
+        if new_state is not None and new_state is not state:
             self.state = new_state
             self.last_state_change = datetime.now()
             return True, cycle_completed
@@ -142,7 +186,7 @@ class MachineMonitor:
             "machine_id": self.machine_id,
             "name": self.name,
             "state": self.state.value,
-            "power": round(self.current_power, 2),
+            "power": self.current_power,
             "door_open": self.door_is_open,
             "cycle_count": self.cycle_count,
             "last_change": self.last_state_change.isoformat()
@@ -156,6 +200,39 @@ class MultiMachineMonitor:
             machine_id: MachineMonitor(machine_id, config)
             for machine_id, config in machines_config.items()
         }
+        # Topic -> machine_id lookups so message dispatch is a single dict hit
+        self.shelly_topic_to_id = {
+            config["shelly_topic"]: machine_id
+            for machine_id, config in machines_config.items()
+        }
+        self.hall_topic_to_id = {
+            f"{machine_id}/hall_sensor/state": machine_id
+            for machine_id in machines_config
+        }
+        # Simulated machines can send power and door state together on one topic
+        self.combined_topic_to_id = {
+            config["combined_topic"]: machine_id
+            for machine_id, config in machines_config.items()
+            if "combined_topic" in config
+        }
+        # Single exact-topic dispatch table: topic -> (payload handler, monitor)
+        self.topic_dispatch = {}
+        for handler, topic_to_id in ((on_shelly_payload, self.shelly_topic_to_id),
+                                     (on_hall_payload, self.hall_topic_to_id),
+                                     (on_combined_payload, self.combined_topic_to_id)):
+            for topic, machine_id in topic_to_id.items():
+                self.topic_dispatch[topic] = (handler, self.monitors[machine_id])
+        # Simulated machines (those with a combined_topic) may also send their JSON topics compressed
+        for machine_id, config in machines_config.items():
+            if "combined_topic" in config:
+                for topic, handler in ((config["shelly_topic"], on_shelly_payload),
+                                       (config["combined_topic"], on_combined_payload)):
+                    self.topic_dispatch[topic + COMPRESSED_SUFFIX] = (
+                        make_decompressing_handler(handler), self.monitors[machine_id])
+        # Counts as last written to disk; saves are skipped while nothing has changed
+        self._last_saved_counts = {}
+        # Saves come from the publish timer and the MQTT network thread; serialize them
+        self._save_lock = threading.Lock()
         self.load_cycle_counts()
 
     def load_cycle_counts(self):
@@ -166,6 +243,10 @@ class MultiMachineMonitor:
                 for machine_id, count in counts.items():
                     if machine_id in self.monitors:
                         self.monitors[machine_id].cycle_count = count
+                self._last_saved_counts = {
+                    machine_id: monitor.cycle_count
+                    for machine_id, monitor in self.monitors.items()
+                }
                 print(f"Loaded cycle counts: {counts}")
         except FileNotFoundError:
             print("No previous cycle counts found, starting fresh")
@@ -173,14 +254,23 @@ class MultiMachineMonitor:
             print(f"Error loading cycle counts: {e}")
 
     def save_cycle_counts(self):
-        """Save cycle counts to file"""
+        """Save cycle counts to file atomically (temp file + rename), only if they changed"""
         try:
-            counts = {
-                machine_id: monitor.cycle_count
-                for machine_id, monitor in self.monitors.items()
-            }
-            with open(CYCLE_COUNT_FILE, 'w') as f:
-                json.dump(counts, f, indent=2)
+            tmp_path = CYCLE_COUNT_FILE + ".tmp"
+            with self._save_lock:
+                # Snapshot under the lock, so an older snapshot can't overwrite a newer one
+                counts = {
+                    machine_id: monitor.cycle_count
+                    for machine_id, monitor in self.monitors.items()
+                }
+                if counts == self._last_saved_counts:
+                    return
+                with open(tmp_path, 'w') as f:
+                    json.dump(counts, f, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, CYCLE_COUNT_FILE)
+                self._last_saved_counts = counts
         except Exception as e:
             print(f"Error saving cycle counts: {e}")
 
@@ -198,103 +288,112 @@ class MultiMachineMonitor:
 # Global monitor manager
 monitor_manager = None
 
-def publish_machine_data(client):
+# Periodic publish timer (re-armed on every tick)
+publish_timer = None
+
+def publish_json(client, topic, payload):
+    """QoS 1 publish of a JSON payload; returns False if the outbound queue was full"""
+    if client.publish(topic, _json.dumps(payload), qos=1).rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+        logger.warning("⚠️ Outbound queue full, dropped message for %s", topic)
+        return False
+    return True
+
+def publish_machine_data(client, now=None):
     """
     Publish machine data to AWS IoT Core in the format expected by the backend API.
     Format matches the database schema: {timestamp, MachineID, cycle_number, current, state, door_opened}
+    `now` is the time.time() value of the publish tick, shared by all machines.
     """
-    timestamp = datetime.now().isoformat()
+    if now is None:
+        now = time.time()
+    timestamp = datetime.fromtimestamp(now).isoformat()
+    batch = []
 
     for machine_id, monitor in monitor_manager.monitors.items():
         average_power = monitor.calculate_and_reset_average()
         
-        # Check for state transitions BEFORE publishing
-        state_changed, cycle_completed = monitor.check_transitions()
+        # Check for state transitions BEFORE publishing (evaluates the new 30s average)
+        state_changed, cycle_completed = monitor.check_transitions(now)
         
         if state_changed:
-            logger.info(f"{monitor.name}: {monitor.state.value}")
+            logger.info("%s: %s", monitor.name, monitor.state.value)
         
         if cycle_completed:
             monitor_manager.save_cycle_counts()
-            logger.info(f"✅ Cycle completed! Total cycles: {monitor.cycle_count}")
+            logger.info("✅ Cycle completed! Total cycles: %s", monitor.cycle_count)
         
         # Create payload matching backend API format with UPDATED state
         payload = {
             "timestamp": timestamp,
             "MachineID": machine_id,
             "cycle_number": monitor.cycle_count,
-            "current": round(average_power, 2),
+            "current": average_power,
             "state": monitor.state.value,
             "door_opened": monitor.door_is_open
         }
 
+        if not PUBLISH_PER_MACHINE:
+            batch.append(payload)
+            continue
+
         # Publish to AWS IoT Core topic
         topic = f"washer/{machine_id}/data"
-        client.publish(topic, json.dumps(payload), qos=1)
-
-        logger.info(f"Published to {topic}: {payload}")
+        if publish_json(client, topic, payload):
+            logger.info("Published to %s: %s", topic, payload)
+
+    if batch:
+        # Single publish for all machines: one MQTT/TLS record per interval
+        if publish_json(client, BATCH_TOPIC, {"timestamp": timestamp, "machines": batch}):
+            logger.info("Published %s machine(s) to %s", len(batch), BATCH_TOPIC)
+
+def schedule_publish(client):
+    """Arm a one-shot timer for the next periodic publish"""
+    global publish_timer
+    publish_timer = threading.Timer(PUBLISH_INTERVAL, publish_tick, args=(client,))
+    publish_timer.daemon = True
+    publish_timer.start()
+
+def publish_tick(client):
+    """Timer callback: re-arm the timer first so the cadence survives publish errors"""
+    schedule_publish(client)
+    try:
+        publish_machine_data(client)
+    except Exception as e:
+        logger.error("Error publishing machine data: %s", e)
 
-def on_connect(client, userdata, flags, rc):
+def on_connect(client, userdata, flags, rc, properties=None):
     """Callback for when the client connects to AWS IoT Core"""
     if rc == 0:
         logger.info("✅ Connected to AWS IoT Core!")
-        logger.info(f"Data will be published every {PUBLISH_INTERVAL} seconds")
+        logger.info("Data will be published every %s seconds", PUBLISH_INTERVAL)
     else:
-        logger.error(f"❌ Failed to connect to AWS IoT Core, return code {rc}")
+        logger.error("❌ Failed to connect to AWS IoT Core, return code %s", rc)
 
 def on_message(client, userdata, msg):
     """Callback for when a message is received from MQTT subscriptions"""
     try:
-        # Check if it's a hall sensor message
-        if "/hall_sensor/state" in msg.topic:
-            machine_id = msg.topic.split("/")[0]
-            monitor = monitor_manager.get_monitor(machine_id)
-
-            if monitor:
-                door_state = msg.payload.decode().lower()
-                is_open = door_state in ['open', 'true', '1']
-                monitor.update_door(is_open)
-
-                state_changed, cycle_completed = monitor.check_transitions()
-
-                if state_changed:
-                    logger.info(f"{monitor.name}: {monitor.state.value}")
-
-                if cycle_completed:
-                    monitor_manager.save_cycle_counts()
-                    logger.info(f"✅ Cycle completed! Total cycles: {monitor.cycle_count}")
-
-        # If not hall sensor, check if it's a Shelly plug
-        else:
-            for machine_id, config in MACHINES.items():
-                if msg.topic == config["shelly_topic"]:
-                    monitor = monitor_manager.get_monitor(machine_id)
-                    if monitor:
-                        data = json.loads(msg.payload.decode())
-                        power = data.get("apower", 0.0)
-                        monitor.update_power(power)
-                        state_changed, _ = monitor.check_transitions()
-                        if state_changed:
-                            logger.info(f"{monitor.name}: {monitor.state.value}")
-                    break
+        entry = monitor_manager.topic_dispatch.get(msg.topic)
+        if entry is not None:
+            handler, monitor = entry
+            handler(monitor, msg.payload)
 
     except Exception as e:
-        logger.error(f"Error processing message: {e}")
-        logger.debug(f"Topic: {msg.topic}, Payload: {msg.payload}")
+        logger.error("Error processing message: %s", e)
+        logger.debug("Topic: %s, Payload: %s", msg.topic, msg.payload)
 
-def on_disconnect(client, userdata, rc):
+def on_disconnect(client, userdata, rc, properties=None):
     if rc != 0:
-        logger.warning(f"⚠️ Unexpected disconnect, attempting reconnect...")
+        logger.warning("⚠️ Unexpected disconnect, attempting reconnect...")
         try:
             client.reconnect()
         except Exception as e:
-            logger.error(f"Reconnect failed: {e}")
+            logger.error("Reconnect failed: %s", e)
     else:
         logger.info("🔴 Disconnected from AWS IoT Core")
 
 def on_publish(client, userdata, mid):
     """Callback for when a message is published"""
-    logger.debug(f"📤 Message published, mid: {mid}")
+    logger.debug("📤 Message published, mid: %s", mid)
 
 def on_connect_local(client, userdata, flags, rc):
     """Callback for local MQTT broker connection"""
@@ -302,69 +401,121 @@ def on_connect_local(client, userdata, flags, rc):
         logger.info("✅ Connected to local MQTT broker!")
         logger.info("Subscribing to topics:")
         
-        # Subscribe to Shelly plug topics
-        for machine_id, config in MACHINES.items():
-            shelly_topic = config["shelly_topic"]
-            client.subscribe(shelly_topic, qos=1)
-            logger.info(f"  - {shelly_topic}")
-        
-        # Subscribe to hall sensor topics (from ESP32)
-        for machine_id in MACHINES.keys():
-            hall_topic = f"{machine_id}/hall_sensor/state"
-            client.subscribe(hall_topic, qos=1)
-            logger.info(f"  - {hall_topic}")
+        # Subscribe to every dispatched topic (Shelly plugs, ESP32 hall sensors and
+        # simulator topics) in a single SUBSCRIBE packet
+        topics = list(monitor_manager.topic_dispatch)
+        client.subscribe([(topic, 1) for topic in topics])
+        for topic in topics:
+            logger.info("  - %s", topic)
     else:
-        logger.error(f"❌ Failed to connect to local broker, return code {rc}")
+        logger.error("❌ Failed to connect to local broker, return code %s", rc)
+
+def apply_transitions(monitor):
+    """Run a message-driven transition check and act on the result"""
+    state_changed, cycle_completed = monitor.check_transitions()
+
+    if state_changed:
+        logger.info("%s: %s", monitor.name, monitor.state.value)
+
+    if cycle_completed:
+        monitor_manager.save_cycle_counts()
+        logger.info("✅ Cycle completed! Total cycles: %s", monitor.cycle_count)
+
+def handle_door_state(monitor, door_state):
+    """Apply a hall sensor reading ("open"/"closed") and act on any resulting transition"""
+    is_open = door_state.lower() in ('open', 'true', '1')
+    monitor.update_door(is_open)
+    logger.info("%s: Door %s", monitor.name, 'OPEN' if is_open else 'CLOSED')
+    apply_transitions(monitor)
+
+def handle_power_reading(monitor, data):
+    """Apply a Shelly status payload to a monitor"""
+    power = data.get("apower", 0.0)
+    monitor.update_power(power)
+    logger.debug("%s: Power = %sW", monitor.name, power)
+    # Also fires the door-open timeout between hall sensor messages
+    apply_transitions(monitor)
+
+def on_hall_payload(monitor, payload):
+    """Hall sensor topic: plain-text door state"""
+    handle_door_state(monitor, payload.decode())
+
+def on_shelly_payload(monitor, payload):
+    """Shelly plug topic: JSON status"""
+    handle_power_reading(monitor, _json.loads(payload))
+
+def on_combined_payload(monitor, payload):
+    """Simulator topic carrying both readings: {"shelly": {...}, "hall": "open"|"closed"}"""
+    data = _json.loads(payload)
+    handle_power_reading(monitor, data["shelly"])
+    handle_door_state(monitor, data["hall"])
+
+def make_decompressing_handler(handler):
+    """Wrap a payload handler for a zlib-compressed topic"""
+    def on_compressed_payload(monitor, payload, *args):
+        handler(monitor, zlib.decompress(payload), *args)
+    return on_compressed_payload
 
 def on_message_local(client, userdata, msg):
     """Callback for messages from local MQTT broker (Shelly plugs and ESP32 hall sensors)"""
     try:
-        # Check if it's a hall sensor message from ESP32
-        if "/hall_sensor/state" in msg.topic:
-            machine_id = msg.topic.split("/")[0]
-            monitor = monitor_manager.get_monitor(machine_id)
-
-            if monitor:
-                door_state = msg.payload.decode().lower()
-                is_open = door_state in ['open', 'true', '1']
-                monitor.update_door(is_open)
-                logger.info(f"{monitor.name}: Door {'OPEN' if is_open else 'CLOSED'}")
+        # One dict hit on the exact topic picks both the handler and the machine
+        entry = monitor_manager.topic_dispatch.get(msg.topic)
+        if entry is not None:
+            handler, monitor = entry
+            handler(monitor, msg.payload)
+    except Exception as e:
+        logger.error("Error processing local message: %s", e)
+        logger.debug("Topic: %s, Payload: %s", msg.topic, msg.payload)
 
-                state_changed, cycle_completed = monitor.check_transitions()
+def connect_aws_client():
+    """Create the AWS IoT Core client, configure TLS and connect; returns None on failure"""
+    # Create MQTT client for AWS IoT Core (publishing data)
+    aws_client = mqtt.Client(client_id="raspi-washer-aws", protocol=mqtt.MQTTv5)
+    aws_client.on_connect = on_connect
+    aws_client.on_disconnect = on_disconnect
+    aws_client.on_message = on_message
+    aws_client.on_publish = on_publish
+    aws_client.max_inflight_messages_set(AWS_MAX_INFLIGHT)
+    aws_client.max_queued_messages_set(AWS_MAX_QUEUED)
 
-                if state_changed:
-                    logger.info(f"{monitor.name}: {monitor.state.value}")
+    # Configure TLS for AWS IoT Core
+    try:
+        logger.info("🔧 Configuring TLS for AWS IoT Core...")
+        # Default context verifies the certificate and hostname; refuse anything older than TLS 1.2
+        tls_context = ssl.create_default_context(cafile=CA_PATH)
+        tls_context.load_cert_chain(certfile=CERT_PATH, keyfile=KEY_PATH)
+        tls_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        aws_client.tls_set_context(tls_context)
+        logger.info("✅ TLS configured successfully")
+    except Exception as e:
+        logger.error("❌ Failed to configure TLS: %s", e)
+        return None
 
-                if cycle_completed:
-                    monitor_manager.save_cycle_counts()
-                    logger.info(f"✅ Cycle completed! Total cycles: {monitor.cycle_count}")
-        
-        # Check if it's a Shelly plug message
-        else:
-            for machine_id, config in MACHINES.items():
-                if msg.topic == config["shelly_topic"]:
-                    monitor = monitor_manager.get_monitor(machine_id)
-                    if monitor:
-                        data = json.loads(msg.payload.decode())
-                        power = data.get("apower", 0.0)
-                        monitor.update_power(power)
-                        logger.debug(f"{monitor.name}: Power = {power}W")
-                        state_changed, _ = monitor.check_transitions()
-                        if state_changed:
-                            logger.info(f"{monitor.name}: {monitor.state.value}")
-                    break
+    # Connect to AWS IoT Core
+    try:
+        logger.info("🌐 Connecting to AWS IoT Core: %s:%s", AWS_IOT_BROKER, AWS_IOT_PORT)
+        # Clean session on first connect only; reconnects resume the session and its in-flight messages
+        connect_properties = Properties(PacketTypes.CONNECT)
+        connect_properties.SessionExpiryInterval = AWS_SESSION_EXPIRY
+        aws_client.connect(AWS_IOT_BROKER, AWS_IOT_PORT, keepalive=60,
+                           clean_start=mqtt.MQTT_CLEAN_START_FIRST_ONLY,
+                           properties=connect_properties)
+        logger.info("✅ AWS IoT Core connection initiated")
     except Exception as e:
-        logger.error(f"Error processing local message: {e}")
-        logger.debug(f"Topic: {msg.topic}, Payload: {msg.payload}")
+        logger.error("❌ Failed to connect to AWS IoT Core: %s", e)
+        return None
+
+    return aws_client
 
 def main():
     """Main function to start the MQTT clients"""
     global monitor_manager
 
     logger.info("=" * 70)
-    logger.info(f"IoT Laundry Monitor - Monitoring {len(MACHINES)} machine(s)")
+    logger.info("IoT Laundry Monitor - Monitoring %s machine(s)", len(MACHINES))
     for machine_id, config in MACHINES.items():
-        logger.info(f"  - {config['name']} (ID: {machine_id})")
+        logger.info("  - %s (ID: %s)", config['name'], machine_id)
     logger.info("=" * 70)
 
     # Initialize monitor manager
@@ -375,68 +526,43 @@ def main():
     local_client.on_connect = on_connect_local
     local_client.on_message = on_message_local
 
-    # Create MQTT client for AWS IoT Core (publishing data)
-    aws_client = mqtt.Client(client_id="raspi-washer-aws")
-    aws_client.on_connect = on_connect
-    aws_client.on_disconnect = on_disconnect
-    aws_client.on_message = on_message
-    aws_client.on_publish = on_publish
-
     # Connect to LOCAL MQTT broker (for Shelly plugs)
     try:
-        logger.info(f"🌐 Connecting to local MQTT broker: {LOCAL_MQTT_BROKER}:{LOCAL_MQTT_PORT}")
+        logger.info("🌐 Connecting to local MQTT broker: %s:%s", LOCAL_MQTT_BROKER, LOCAL_MQTT_PORT)
         local_client.connect(LOCAL_MQTT_BROKER, LOCAL_MQTT_PORT, keepalive=60)
-        local_client.loop_start()
         logger.info("✅ Local broker connection initiated")
     except Exception as e:
-        logger.error(f"❌ Failed to connect to local broker: {e}")
+        logger.error("❌ Failed to connect to local broker: %s", e)
         return
 
-    # Configure TLS for AWS IoT Core
-    try:
-        logger.info("🔧 Configuring TLS for AWS IoT Core...")
-        aws_client.tls_set(
-            ca_certs=CA_PATH,
-            certfile=CERT_PATH,
-            keyfile=KEY_PATH,
-            cert_reqs=ssl.CERT_REQUIRED,
-            tls_version=ssl.PROTOCOL_TLS
-        )
-        aws_client.tls_insecure_set(False)
-        logger.info("✅ TLS configured successfully")
-    except Exception as e:
-        logger.error(f"❌ Failed to configure TLS: {e}")
-        return
-
-    # Connect to AWS IoT Core
-    try:
-        logger.info(f"🌐 Connecting to AWS IoT Core: {AWS_IOT_BROKER}:{AWS_IOT_PORT}")
-        aws_client.connect(AWS_IOT_BROKER, AWS_IOT_PORT, keepalive=60)
-        aws_client.loop_start()
-        logger.info("✅ AWS IoT Core connection initiated")
-    except Exception as e:
-        logger.error(f"❌ Failed to connect to AWS IoT Core: {e}")
-        return
+    if USE_MOSQUITTO_BRIDGE:
+        # Publishes go to the local broker, which forwards them to AWS IoT Core
+        logger.info("🌉 Publishing through the local broker's AWS IoT bridge")
+        aws_client = local_client
+    else:
+        aws_client = connect_aws_client()
+        if aws_client is None:
+            return
+        # The local client gets its own network thread; the main thread drives the AWS client
+        local_client.loop_start()
 
     # Main monitoring loop
     logger.info("\n🔄 Monitoring started (Press Ctrl+C to exit)\n")
-    last_publish_time = time.time()
+    # Periodic publishes run on a timer, so the main thread can drive the publishing client
+    schedule_publish(aws_client)
 
     try:
-        while True:
-            current_time = time.time()
-            if current_time - last_publish_time >= PUBLISH_INTERVAL:
-                publish_machine_data(aws_client)
-                last_publish_time = current_time
-            time.sleep(1)
-            
+        # Blocking call that processes traffic on the publishing client and handles
+        # reconnecting, so no separate loop_start() thread or polling loop is needed.
+        aws_client.loop_forever()
     except KeyboardInterrupt:
         logger.info("\n⏹️  Shutting down gracefully...")
+        publish_timer.cancel()
         monitor_manager.save_cycle_counts()
-        local_client.loop_stop()
+        if aws_client is not local_client:
+            local_client.loop_stop()
+            aws_client.disconnect()
         local_client.disconnect()
-        aws_client.loop_stop()
-        aws_client.disconnect()
         logger.info("👋 Shutdown complete")
 
 if __name__ == "__main__":
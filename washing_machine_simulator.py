@@ -6,12 +6,12 @@ Publishes Shelly plug data to local MQTT broker
 The data is then picked up by washing_machine_monitor_v2.py and forwarded to AWS IoT Core
 """
 import paho.mqtt.client as mqtt
-import json
 import time
-import random
 import logging
-import pandas as pd
+import numpy as np
 import os
+import socket
+import zlib
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -33,139 +33,280 @@ SIMULATED_MACHINES = {
 # Update frequency in seconds
 SENSOR_UPDATE_INTERVAL = 10  # Match the ~10 second intervals in power_log_gus.csv
 
+# Send Shelly data and door state in one message per machine on simulator/{id}/all
+# (False: separate Shelly and hall sensor topics, like the real devices)
+PUBLISH_COMBINED = True
+
+# QoS for simulator publishes. Readings are replaced every SENSOR_UPDATE_INTERVAL,
+# so 0 skips the PUBACK round trip and inflight tracking; set 1 when every reading must arrive
+PUBLISH_QOS = 0
+
+# Hall sensor payloads as bytes, so paho doesn't re-encode the door state on every publish
+HALL_PAYLOADS = {"open": b"open", "closed": b"closed"}
+
+# zlib-compress the JSON messages (Shelly / combined) and publish them on "<topic>/z".
+# Only worth it when bandwidth costs more than CPU, e.g. when forwarding off the Pi.
+COMPRESS_PAYLOAD = False
+COMPRESSED_SUFFIX = "/z"
+# Door states by door table value (0 = open, 1 = closed)
+DOOR_STATES = ("open", "closed")
+# Seed for the door table, so the replayed door timing is the same on every run
+DOOR_TABLE_SEED = 42
+
+# Shelly status JSON with fixed-position slots: output, apower, voltage, current,
+# aenergy.total, temperature tC/tF. Formatting it directly skips dict building and json.dumps.
+SHELLY_TEMPLATE = (
+    '{"id":0,"source":"init","output":%s,"apower":%.2f,"voltage":%.1f,"current":%.3f,'
+    '"aenergy":{"total":%.2f,"by_minute":[0.0,0.0,0.0]},'
+    '"temperature":{"tC":%.1f,"tF":%.1f}}'
+)
+# Voltage/energy/temperature filler is re-drawn every this many ticks; in between, an
+# unchanged power reading reuses the previous serialized payload
+NOISE_REFRESH_TICKS = 6
+
+# ---- Random Numbers ----
+# Uniform [0, 1) draws are generated in bulk and handed out from a pool,
+# instead of one random-module call per noise field. The pool stays a float32 array
+# (256 KB); only the handed-out slice is converted to Python floats
+RNG_POOL_SIZE = 1 << 16
+_rng = np.random.default_rng()
+_pool = _rng.random(RNG_POOL_SIZE, dtype=np.float32)
+_pool_pos = 0
+
+def next_randoms(n):
+    """Return the next n uniform [0, 1) floats from the pool, refilling it when exhausted"""
+    global _pool, _pool_pos
+    if _pool_pos + n > RNG_POOL_SIZE:
+        _pool = _rng.random(RNG_POOL_SIZE, dtype=np.float32)
+        _pool_pos = 0
+    start = _pool_pos
+    _pool_pos += n
+    return _pool[start:_pool_pos].tolist()
+
+# ---- Replay Data ----
+# Loaded once in main() and shared by every SimulatedMachine; each machine
+# only keeps its own position in the log
+_POWER = None  # power_w samples (see load_power_log)
+_DOORS = None  # door state per sample, 0 = open / 1 = closed (see build_door_table)
+
 class SimulatedMachine:
     """Replays power data from CSV file with realistic state tracking"""
     
-    def __init__(self, machine_id, name, power_data, offset=0):
+    def __init__(self, machine_id, name, offset=0):
+        # Reads the shared _POWER / _DOORS tables, which must be loaded first
         self.machine_id = machine_id
         self.name = name
-        self.power_data = power_data
-        self.current_index = offset % len(power_data)  # Start position with offset
-        self.current_power = power_data.iloc[self.current_index]['power_w']
-        self.previous_power = self.current_power
-        self.was_washing = False  # Track if machine was recently washing
-        self.just_finished = False  # Track if machine just finished a cycle
+        self._n = len(_POWER)
+        self.current_index = offset % self._n  # Start position with offset
+        self.current_power = _POWER[self.current_index]
+        # Topics are fixed per machine, so build them once
+        self.combined_topic = f"simulator/{machine_id}/all"
+        self.shelly_topic = f"simulator/{machine_id}/shelly"
+        self.hall_topic = f"{machine_id}/hall_sensor/state"
+        self.current_sample = self.current_index  # Index of current_power in the log
+        self._noise = None  # (voltage, energy total, tC, tF) filler values
+        self._noise_ticks = 0  # Ticks left before the filler is re-drawn
+        self._cached_power = None  # Power reading the cached payload was built from
+        self._cached_payload = None
     
     def get_next_power(self):
         """Get next power reading from CSV data"""
-        power = self.power_data.iloc[self.current_index]['power_w']
+        self.current_sample = self.current_index
+        power = _POWER[self.current_index]
         
         # Move to next sample (loop back to start when finished)
-        self.current_index = (self.current_index + 1) % len(self.power_data)
+        i = self.current_index + 1
+        self.current_index = 0 if i >= self._n else i
         
         return power
     
-    def get_shelly_data(self):
-        """Generate Shelly plug data using real power readings from CSV"""
-        # Store previous power to detect transitions
-        self.previous_power = self.current_power
-        
+    def get_shelly_payload(self):
+        """Generate the serialized Shelly plug status (bytes) using real power readings from CSV"""
         # Get next power reading from CSV
         self.current_power = self.get_next_power()
         
-        # Detect state transitions
-        if self.current_power > 20:
-            self.was_washing = True
-            self.just_finished = False
-        elif self.current_power <= 8 and self.was_washing:
-            # Transition from washing to idle - machine just finished
-            self.just_finished = True
-            self.was_washing = False
-        
-        return {
-            "id": 0,
-            "source": "init",
-            "output": bool(self.current_power > 5),  # Convert to native Python bool
-            "apower": float(round(self.current_power, 2)),  # Convert to native Python float
-            "voltage": round(random.uniform(230, 240), 1),
-            "current": round(float(self.current_power) / 230, 3),
-            "aenergy": {
-                "total": round(random.uniform(1000, 2000), 2),
-                "by_minute": [0.0, 0.0, 0.0]
-            },
-            "temperature": {
-                "tC": round(random.uniform(20, 35), 1),
-                "tF": round(random.uniform(68, 95), 1)
-            }
-        }
+        # Re-draw the voltage, energy total and temperature filler every NOISE_REFRESH_TICKS
+        self._noise_ticks -= 1
+        if self._noise_ticks <= 0:
+            r_voltage, r_energy, r_temp_c, r_temp_f = next_randoms(4)
+            self._noise = (230 + 10 * r_voltage, 1000 + 1000 * r_energy,
+                           20 + 15 * r_temp_c, 68 + 27 * r_temp_f)
+            self._noise_ticks = NOISE_REFRESH_TICKS
+            self._cached_power = None
+
+        # Long idle stretches repeat the same reading: reuse the serialized payload
+        if self.current_power != self._cached_power:
+            voltage, energy_total, temp_c, temp_f = self._noise
+            self._cached_payload = (SHELLY_TEMPLATE % (
+                "true" if self.current_power > 5 else "false",
+                self.current_power,
+                voltage,
+                self.current_power / 230,
+                energy_total,
+                temp_c,
+                temp_f,
+            )).encode()
+            self._cached_power = self.current_power
+        return self._cached_payload
     
     def get_hall_sensor_state(self):
-        """Generate door state based on power consumption rules:
-        1. Idle (6-8W, never washed): Door is open
-        2. Washing (>20W): Door is always closed
-        3. Just finished (6-8W after being >20W): 80% chance closed, 20% chance open
-        """
-        if self.current_power > 20:
-            # Washing phase - door always closed
-            return "closed"
-        elif self.current_power <= 8 and self.just_finished:
-            # Just finished washing - 80% chance door still closed, 20% chance opened
-            if random.random() < 0.8:
-                return "closed"
-            else:
-                # User opened the door to collect laundry
-                self.just_finished = False  # Reset state after door is opened
-                return "open"
-        else:
-            # Idle/waiting to start - door is open
-            return "open"
+        """Door state for the current power sample, looked up in the precomputed door table"""
+        return DOOR_STATES[_DOORS[self.current_sample]]
 
 def on_connect(client, userdata, flags, rc):
     """Callback for when the client connects to local MQTT broker"""
     if rc == 0:
         logger.info("✅ Simulator connected to local MQTT broker!")
     else:
-        logger.error(f"❌ Failed to connect, return code {rc}")
+        logger.error("❌ Failed to connect, return code %s", rc)
 
 def on_disconnect(client, userdata, rc):
     """Callback for when the client disconnects"""
     if rc != 0:
-        logger.warning(f"⚠️ Unexpected disconnect, attempting reconnect...")
+        logger.warning("⚠️ Unexpected disconnect, attempting reconnect...")
         try:
             client.reconnect()
         except Exception as e:
-            logger.error(f"Reconnect failed: {e}")
+            logger.error("Reconnect failed: %s", e)
+
+def run_network_loop(client, deadline):
+    """Drive the MQTT network loop in this thread until deadline (time.monotonic())"""
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        if client.loop(timeout=min(1.0, remaining)) == mqtt.MQTT_ERR_NO_CONN:
+            # No socket (e.g. on_disconnect's reconnect failed): retry once, else wait for the next tick
+            try:
+                client.reconnect()
+            except Exception as e:
+                logger.error("Reconnect failed: %s", e)
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                return
 
-def on_publish(client, userdata, mid):
-    """Callback for when a message is published"""
-    logger.debug(f"📤 Published message, mid: {mid}")
+def set_tcp_cork(client, enabled):
+    """Hold back (or flush) partial TCP segments on the client's socket; Linux only, no-op elsewhere"""
+    sock = client.socket()
+    if sock is None or not hasattr(socket, "TCP_CORK"):
+        return
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, 1 if enabled else 0)
+    except OSError as e:
+        logger.debug("TCP_CORK not applied: %s", e)
 
 def publish_sensor_data(client, machines):
     """Publish simulated sensor data for all machines"""
-    for machine_id, machine in machines.items():
-        # Publish Shelly plug data (power consumption)
-        shelly_topic = f"simulator/{machine_id}/shelly"
-        shelly_data = machine.get_shelly_data()
-        client.publish(shelly_topic, json.dumps(shelly_data), qos=1)
-        
-        # Publish hall sensor data (door state)
-        hall_topic = f"{machine_id}/hall_sensor/state"
+    # Build every (topic, payload) for this tick first...
+    messages = []
+    log_info = logger.isEnabledFor(logging.INFO)  # Skip the per-machine log line entirely above INFO
+    for machine in machines.values():
+        shelly_payload = machine.get_shelly_payload()
         hall_state = machine.get_hall_sensor_state()
-        client.publish(hall_topic, hall_state, qos=1)
+
+        if PUBLISH_COMBINED:
+            # One publish per machine carrying both readings
+            json_topic = machine.combined_topic
+            json_payload = b'{"shelly":%s,"hall":"%s"}' % (shelly_payload, HALL_PAYLOADS[hall_state])
+        else:
+            # Shelly plug data (power consumption)
+            json_topic = machine.shelly_topic
+            json_payload = shelly_payload
+
+        if COMPRESS_PAYLOAD:
+            json_topic += COMPRESSED_SUFFIX
+            json_payload = zlib.compress(json_payload, 1)
+        messages.append((json_topic, json_payload))
+
+        if not PUBLISH_COMBINED:
+            # Hall sensor data (door state)
+            messages.append((machine.hall_topic, HALL_PAYLOADS[hall_state]))
         
-        logger.info(f"{machine.name}: Power={shelly_data['apower']}W, Door={hall_state}")
+        if log_info:
+            logger.info("%s: Power=%.2fW, Door=%s", machine.name, machine.current_power, hall_state)
+
+    # ...then publish them back to back. With no loop_start thread, each publish()
+    # writes its packet to the socket straight away from this thread; corking the
+    # socket around the batch lets the kernel send the tick as full segments
+    set_tcp_cork(client, True)
+    try:
+        for topic, payload in messages:
+            client.publish(topic, payload, qos=PUBLISH_QOS)
+    finally:
+        set_tcp_cork(client, False)
+
+def load_power_log(path):
+    """Load the power_w column of a power log CSV as a flat float array"""
+    with open(path) as f:
+        power_column = f.readline().strip().split(",").index("power_w")
+    return np.loadtxt(path, delimiter=",", skiprows=1, usecols=power_column, dtype=np.float64)
+
+def build_door_table(power_data, seed=DOOR_TABLE_SEED):
+    """Precompute the door state for every sample of the power log (0 = open, 1 = closed):
+    1. Idle (6-8W, never washed): Door is open
+    2. Washing (>20W): Door is always closed
+    3. Just finished (6-8W after being >20W): 80% chance closed, 20% chance open
+       per sample, until the user opens it
+    The log is replayed in a loop, so it is walked twice and the second pass is kept:
+    that way the state carried across the wrap point is already settled.
+    """
+    powers = power_data.tolist()
+    draws = np.random.default_rng(seed).random(2 * len(powers)).tolist()
+    door_table = np.empty(len(powers), dtype=np.uint8)
+    was_washing = False  # Machine was recently washing
+    just_finished = False  # Machine just finished a cycle and the door wasn't opened yet
+    draw = 0
+
+    for _ in range(2):
+        for i, power in enumerate(powers):
+            # Detect state transitions
+            if power > 20:
+                was_washing = True
+                just_finished = False
+            elif power <= 8 and was_washing:
+                # Transition from washing to idle - machine just finished
+                just_finished = True
+                was_washing = False
+
+            if power > 20:
+                # Washing phase - door always closed
+                door_table[i] = 1
+            elif power <= 8 and just_finished:
+                # Just finished washing - 80% chance door still closed, 20% chance opened
+                if draws[draw] < 0.8:
+                    door_table[i] = 1
+                else:
+                    # User opened the door to collect laundry
+                    just_finished = False
+                    door_table[i] = 0
+            else:
+                # Idle/waiting to start - door is open
+                door_table[i] = 0
+            draw += 1
+
+    return door_table
 
 def main():
     """Main simulator function"""
+    global _POWER, _DOORS
     logger.info("=" * 70)
-    logger.info(f"Washing Machine Simulator - Simulating {len(SIMULATED_MACHINES)} machines")
+    logger.info("Washing Machine Simulator - Simulating %s machines", len(SIMULATED_MACHINES))
     
     # Load power data from CSV
     if not os.path.exists(POWER_LOG_FILE):
-        logger.error(f"❌ Power log file not found: {POWER_LOG_FILE}")
-        logger.error(f"   Please ensure {POWER_LOG_FILE} is in the current directory")
+        logger.error("❌ Power log file not found: %s", POWER_LOG_FILE)
+        logger.error("   Please ensure %s is in the current directory", POWER_LOG_FILE)
         return
     
-    logger.info(f"📂 Loading power data from {POWER_LOG_FILE}")
-    power_data = pd.read_csv(POWER_LOG_FILE)
-    logger.info(f"✅ Loaded {len(power_data)} power samples (~{len(power_data)*10/60:.1f} minutes of data)")
+    logger.info("📂 Loading power data from %s", POWER_LOG_FILE)
+    _POWER = load_power_log(POWER_LOG_FILE)
+    _DOORS = build_door_table(_POWER)
+    logger.info("✅ Loaded %s power samples (~%.1f minutes of data)", len(_POWER), len(_POWER)*10/60)
     
-    # Initialize simulated machines with power data
+    # Initialize simulated machines over the shared power data
     machines = {
         machine_id: SimulatedMachine(
             machine_id, 
             config["name"], 
-            power_data,
             config["offset"]
         )
         for machine_id, config in SIMULATED_MACHINES.items()
@@ -173,42 +314,44 @@ def main():
     
     for machine_id, machine in machines.items():
         offset_min = SIMULATED_MACHINES[machine_id]["offset"] // 60
-        logger.info(f"  - {machine.name} (ID: {machine_id}, offset: {offset_min} min)")
+        logger.info("  - %s (ID: %s, offset: %s min)", machine.name, machine_id, offset_min)
     logger.info("=" * 70)
     
     # Create MQTT client
     client = mqtt.Client(client_id="washing-machine-simulator")
     client.on_connect = on_connect
     client.on_disconnect = on_disconnect
-    client.on_publish = on_publish
     
     # Connect to local MQTT broker
     try:
-        logger.info(f"🌐 Connecting to local MQTT broker: {MQTT_BROKER}:{MQTT_PORT}")
+        logger.info("🌐 Connecting to local MQTT broker: %s:%s", MQTT_BROKER, MQTT_PORT)
         client.connect(MQTT_BROKER, MQTT_PORT, keepalive=60)
         logger.info("✅ Connection initiated")
     except Exception as e:
-        logger.error(f"❌ Failed to connect to local MQTT broker: {e}")
+        logger.error("❌ Failed to connect to local MQTT broker: %s", e)
         return
     
-    # Start network loop
-    client.loop_start()
-    
-    # Give connection time to establish
-    time.sleep(2)
+    # Network I/O runs in this thread between publishes (no loop_start thread);
+    # give the connection time to establish
+    run_network_loop(client, time.monotonic() + 2)
     
     # Main simulation loop
     logger.info("\n🔄 Simulation started (Press Ctrl+C to exit)\n")
+    # Publish on fixed monotonic deadlines, so publish time doesn't stretch the interval
+    next_publish = time.monotonic()
     
     try:
         while True:
             # Publish sensor data every interval
             publish_sensor_data(client, machines)
-            time.sleep(SENSOR_UPDATE_INTERVAL)
+            next_publish += SENSOR_UPDATE_INTERVAL
+            # Skip missed ticks instead of bursting to catch up
+            if next_publish < time.monotonic():
+                next_publish = time.monotonic() + SENSOR_UPDATE_INTERVAL
+            run_network_loop(client, next_publish)
             
     except KeyboardInterrupt:
         logger.info("\n⏹️  Shutting down simulator...")
-        client.loop_stop()
         client.disconnect()
         logger.info("👋 Simulator stopped")
 